@@ -3,28 +3,166 @@ from logging import warning, info, error
 import logging
 
 from socket import inet_ntoa, inet_aton, gethostname
+from socket import socket, IPPROTO_TCP, TCP_NODELAY, SHUT_WR
+from socket import SOL_SOCKET, SO_KEEPALIVE
+
+try:  # linux only
+    from socket import TCP_CORK
+except ImportError:
+    TCP_CORK = None
+
+try:  # not on windows
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = None
 import asyncio
 import struct
+import sys
+import os
+
+
+_RELAY_BUFSIZE = 1 << 16
+
+# beyond a few thousand connections the socket buffers alone blow
+# the cache and relay copies start paying DRAM latency
+_MAX_CONNS = 1024
+
+# splice moves bytes between fds kernel side, sparing the relay
+# two userspace copies per chunk; linux only
+_SPLICE = sys.platform == 'linux' and hasattr(os, 'splice')
+
+# with reuse on, how long a finished client waits on a quiet
+# server before the exchange is called over; the clock restarts
+# whenever response bytes flow
+_REUSE_LINGER = 1.0
+
+_REPLY_OK = b'\x00\x5A\xFF\xFF\xFF\xFF\xFF\xFF'
+_REPLY_FAIL = b'\x00\x5B\xFF\xFF\xFF\xFF\xFF\xFF'
+
+# compiled once; the address comes out as the 4 network-order
+# bytes inet_ntoa wants, no intermediate pack
+_REQ = struct.Struct('!BBH4s')
+
+# relay buffers are reused across connections rather than
+# allocated and thrown away once per chunk
+_BUF_POOL = []
+
+
+def _getbuf(size):
+    '''@brief pop a relay buffer off the pool, or allocate one
+    '''
+
+    if _BUF_POOL and len(_BUF_POOL[-1]) == size:
+        return _BUF_POOL.pop()
+    return bytearray(size)
+
+
+def _putbuf(buf):
+    '''@brief hand a relay buffer back to the pool
+    '''
+
+    _BUF_POOL.append(buf)
+
+
+def _buffered(reader):
+    '''@brief steal the bytes already fed to a stream reader
+
+    @details once the transport is paused we read from the raw
+    socket ourselves, so whatever the transport buffered before
+    the pause must be forwarded by hand.
+    '''
+
+    data = bytes(reader._buffer)
+    reader._buffer.clear()
+    return data
+
+
+async def _readable(loop, sock):
+    '''@brief wait until sock has bytes to read
+    '''
+
+    fut = loop.create_future()
+    loop.add_reader(sock, fut.set_result, None)
+    try:
+        await fut
+    finally:
+        loop.remove_reader(sock)
+
+
+async def _writable(loop, sock):
+    '''@brief wait until sock can accept bytes
+    '''
+
+    fut = loop.create_future()
+    loop.add_writer(sock, fut.set_result, None)
+    try:
+        await fut
+    finally:
+        loop.remove_writer(sock)
+
+
+def _nodelay(writer):
+    '''@brief disable nagle on the socket behind a stream writer
+    '''
+
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
 
 class Socks:
-    def __init__(self, host, port, log=False):
+    def __init__(self, host, port, log=False, bufsize=_RELAY_BUFSIZE,
+            reuse=False, maxconns=_MAX_CONNS, reuseport=False):
+        self._reuseport = reuseport
         self._host, self._port = host, port
         self._log = log
+        self._bufsize = bufsize
+
+        # accepted connections past the cap wait their turn before
+        # the handshake, keeping the relay working set in cache
+        self._sem = asyncio.Semaphore(maxconns)
+
+        # upstream connections pooled by destination; raw socks has
+        # no end-of-exchange signal, so this is opt-in for clients
+        # whose protocols survive it
+        self._reuse = reuse
+        self._pool = {}
+        self._plock = asyncio.Lock()
+
+        # the streams protocol drops its reference to the session
+        # task on connection_lost; ours keeps it alive to the end
+        self._tasks = set()
 
         if log: logging.basicConfig(level=logging.INFO)
         else: logging.basicConfig(level=logging.CRITICAL)
 
     def start(self):
         info(f'starting socks4 server at {self._host}:{self._port}')
-        asyncio.run(self._start(self._host, self._port))
+
+        try:  # libuv pays less per i/o event than the stock loop
+            from uvloop import run
+        except ImportError:
+            run = asyncio.run
+
+        run(self._start(self._host, self._port))
 
     async def _start(self, host, port):
         '''@brief server main coroutine.
+
+        @details with reuseport the listening socket is built by
+        hand so SO_REUSEPORT can be set before the bind: several
+        worker processes then listen on the same address and the
+        kernel load-balances accepts across them.
         '''
-        
-        server = await asyncio.start_server(
-            self._serve, host, port)
+
+        if self._reuseport and SO_REUSEPORT is not None:
+            lsock = socket()
+            lsock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            lsock.bind((host, port))
+
+            server = await asyncio.start_server(self._serve, sock=lsock)
+        else:
+            server = await asyncio.start_server(self._serve, host, port)
 
         async with server:
             await server.serve_forever()
@@ -41,23 +179,40 @@ class Socks:
         @param writer writable client transport
         '''
 
-        _bufsize = 1 << 12
-        req = await reader.read(_bufsize)
+        # if the client leg dies mid-session, connection_lost lets
+        # go of this task; without a reference of our own it can be
+        # collected mid-await, semaphore slot and server leg in hand
+        task = asyncio.current_task()
+        self._tasks.add(task)
 
-        # for now do not handle ident
-        if len(req) < 8:
-            error(f'request badly formed: {hexlify(req)}')
-            return
-
-        vn, cd, port, ip = struct.unpack('!BBHI', req[:8])
-        addr = inet_ntoa(struct.pack('!I', ip))
-
-        if cd == 1:    # CONNECT method
-            await self._connect(reader, writer, addr, port)
-        elif cd == 2:  # BIND method
-            await self._bind(reader, writer, addr, port)
-        else:
-            error(f'incorrect SOCKS4 method: {cd}')
+        try:
+            async with self._sem:
+                # the ident goes unused but must be consumed through
+                # its terminator: whatever follows it is relay payload
+                try:
+                    req = await reader.readexactly(8)
+                    await reader.readuntil(b'\x00')
+                except asyncio.IncompleteReadError as exc:
+                    if self._log:
+                        error(f'request badly formed: {hexlify(exc.partial)}')
+                    return
+                except asyncio.LimitOverrunError:
+                    if self._log:
+                        error('request badly formed: unterminated ident')
+                    return
+
+                vn, cd, port, ip = _REQ.unpack(req)
+                addr = inet_ntoa(ip)
+
+                if cd == 1:    # CONNECT method
+                    await self._connect(reader, writer, addr, port)
+                elif cd == 2:  # BIND method
+                    await self._bind(reader, writer, addr, port)
+                else:
+                    if self._log:
+                        error(f'incorrect SOCKS4 method: {cd}')
+        finally:
+            self._tasks.discard(task)
 
     async def _connect(self, reader, writer, addr, port):
         '''@brief handle CONNECT request by client
@@ -74,22 +229,155 @@ class Socks:
         '''
 
         try:
-            sreader, swriter = await asyncio.open_connection(addr, port)
-        except:
-            error(f'failed to connect to {addr}:{port}')
-            writer.write(b'\x00\x5B\xFF\xFF\xFF\xFF\xFF\xFF')
+            sreader, swriter = await self._acquire(addr, port)
+        except OSError:
+            if self._log:
+                error(f'failed to connect to {addr}:{port}')
+            writer.write(_REPLY_FAIL)
             await writer.drain()
-            writer.close()
+            await self._close(writer)
             return
 
+        # nagle + delayed acks stall the reply and first relay chunk
+        _nodelay(writer)
+        _nodelay(swriter)
+
         # reply success
-        info(f'setting up relays for {addr}:{port}')
-        writer.write(b'\x00\x5A\xFF\xFF\xFF\xFF\xFF\xFF')
+        if self._log:
+            info(f'setting up relays for {addr}:{port}')
+
+        sock = writer.get_extra_info('socket')
+        if TCP_CORK is not None and sock is not None:
+            # cork the reply so any server bytes that already came
+            # in leave in the same segment as the 8-byte ack. no
+            # waiting for more: clients of speak-first protocols
+            # cannot send until they see the ack, so a stall here
+            # is pure added latency on every connect
+            sock.setsockopt(IPPROTO_TCP, TCP_CORK, 1)
+            writer.write(_REPLY_OK)
+
+            fm = _buffered(sreader)
+            if fm:
+                writer.write(fm)
+            sock.setsockopt(IPPROTO_TCP, TCP_CORK, 0)
+        else:
+            writer.write(_REPLY_OK)
         await writer.drain()
-        
-        # set up relays
-        asyncio.create_task(self._relay(reader, swriter))
-        asyncio.create_task(self._relay(sreader, writer))
+
+        if self._reuse:
+            await self._pipe_reuse(reader, writer, sreader, swriter,
+                addr, port)
+        else:
+            await self._pipe(reader, writer, sreader, swriter)
+
+    async def _acquire(self, addr, port):
+        '''@brief get a connection to addr:port, pooled if possible
+
+        @details pooled connections may have gone stale since they
+        were handed back; those are discarded on the way out. fresh
+        connections get SO_KEEPALIVE so a pooled one does not rot
+        silently behind a dead peer.
+
+        @param addr address of requested server
+        @param port port of requested server
+        '''
+
+        async with self._plock:
+            conns = self._pool.get((addr, port), [])
+            while conns:
+                sreader, swriter = conns.pop()
+                if not self._healthy(sreader, swriter):
+                    swriter.close()
+                    continue
+                return sreader, swriter
+
+        sreader, swriter = await asyncio.open_connection(addr, port)
+        sock = swriter.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        return sreader, swriter
+
+    def _healthy(self, sreader, swriter):
+        '''@brief whether an idle connection is fit for another session
+
+        @details a closed or eof'd connection is spent, and one with
+        bytes already buffered spoke after its session ended — those
+        bytes belong to no one, so the connection is dirty and the
+        next session must not see them.
+        '''
+
+        return not (swriter.is_closing() or sreader.at_eof()
+            or _buffered(sreader))
+
+    async def _release(self, addr, port, sreader, swriter):
+        '''@brief hand a connection back to the pool, if healthy
+        '''
+
+        if not self._healthy(sreader, swriter):
+            swriter.close()
+            return
+
+        async with self._plock:
+            self._pool.setdefault((addr, port), []).append(
+                (sreader, swriter))
+
+    async def _pipe_reuse(self, reader, writer, sreader, swriter,
+            addr, port):
+        '''@brief relay both directions, keeping the server leg open
+
+        @details a pooled server never signals end-of-exchange by
+        closing, so the session cannot simply wait it out: it ends
+        when the server leg finishes on its own, when the client
+        connection goes away, or — once the client has sent its
+        last byte — when the response stops flowing for
+        _REUSE_LINGER. half-close-then-read clients get their
+        response as long as it keeps moving; a response that goes
+        quiet past the linger is cut, which is the price of the
+        opt-in. the client leg never half-closes the server, which
+        must stay writable for the next session.
+
+        @param reader readable client transport
+        @param writer writable client transport
+        @param sreader readable server transport
+        @param swriter writable server transport
+        @param addr address of requested server
+        @param port port of requested server
+        '''
+
+        up = asyncio.create_task(self._relay(reader, swriter, eof=False))
+
+        moved = [0]
+        down = asyncio.create_task(self._relay(sreader, writer, moved=moved))
+        gone = asyncio.create_task(writer.wait_closed())
+
+        try:
+            await asyncio.wait({up, down, gone},
+                return_when=asyncio.FIRST_COMPLETED)
+
+            # the client finishing only means the request was sent;
+            # linger while the response flows and call the exchange
+            # over once it stops
+            seen = -1
+            while not (down.done() or gone.done()) and moved[0] > seen:
+                seen = moved[0]
+                await asyncio.wait({down, gone}, timeout=_REUSE_LINGER,
+                    return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            up.cancel()
+            down.cancel()
+
+            # both relays must be fully unwound before the
+            # connection changes hands, or their read waiters
+            # linger on the streams the next session reads
+            await asyncio.gather(up, down, return_exceptions=True)
+
+            # closing the client resolves the waiter behind gone;
+            # cancelling gone instead would cancel that shared
+            # future out from under wait_closed
+            await self._close(writer)
+            await asyncio.gather(gone, return_exceptions=True)
+
+            await self._release(addr, port, sreader, swriter)
 
     async def _bind(self, reader, writer, addr, port):
         '''@brief handle BIND request by client
@@ -98,7 +386,10 @@ class Socks:
         attempt fails, report failure to client and close
         connection with client. if this attempt succeeds, send
         our hostname and os assigned port to client, and wait
-        for the server with address `addr` to connect.
+        for the server with address `addr` to connect. a full
+        asyncio server is overkill for the one expected
+        connection: listen on a raw socket, accept once, and
+        close the listener right away.
 
         @param reader readable client transport
         @param writer writable client transport
@@ -106,63 +397,283 @@ class Socks:
         @param port expected server port
         '''
 
+        loop = asyncio.get_running_loop()
+
         try:  # try to bind
-            server = await asyncio.start_server(
-                self._bound(reader, writer, addr, port),
-                gethostname(), 0)  # os assigned port
-        except:
-            writer.write(b'\x00\x5B\xFF\xFF\xFF\xFF\xFF\xFF')
+            lsock = socket()
+            lsock.bind((gethostname(), 0))  # os assigned port
+            lsock.listen(1)
+            lsock.setblocking(False)
+        except OSError:
+            writer.write(_REPLY_FAIL)
             await writer.drain()
-            error(f'could not bind to wait for {addr}:{port}')
+            if self._log:
+                error(f'could not bind to wait for {addr}:{port}')
             return
 
-        # reply to client
-        saddr, sport = server.get_extra_info('sockname')
-        writer.write(b'\x00\x5A' + \
-            sport.to_bytes(2, 'big') + \
-            inet_aton(saddr).to_bytes(4, 'big'))
-        await writer.drain()
+        try:
+            # reply to client
+            saddr, sport = lsock.getsockname()
+            writer.write(struct.pack('!BBH4s', 0, 0x5A, sport, inet_aton(saddr)))
+            await writer.drain()
 
-        # start waiting for server's connection
-        async with server:
-            await server.serve_forever()
+            # accept until the right server connects
+            while True:
+                conn, (raddr, _) = await loop.sock_accept(lsock)
+                if raddr == addr:
+                    break
+
+                if self._log:
+                    error(f'wrong server connecting to BIND: {raddr}')
+                conn.close()
+        finally:
+            lsock.close()
+
+        sreader, swriter = await asyncio.open_connection(sock=conn)
 
-    def _bound(self, reader, writer, addr, port):
-        '''@brief wait for server to connect
+        _nodelay(writer)
+        _nodelay(swriter)
 
-        @details expect server with address `addr` to connect.
-        when it does, check the address and set up a relay
-        between the server and the client.
+        # set up relays
+        await self._pipe(reader, writer, sreader, swriter)
+
+    async def _pipe(self, reader, writer, sreader, swriter):
+        '''@brief relay both directions between client and server
+
+        @details on linux, relay through splice so the bytes never
+        enter userspace; elsewhere fall back on the stream copy
+        loop. each relay half-closes its writer on eof so the peer
+        sees its read return empty, and the whole connection comes
+        down once both directions are over.
 
         @param reader readable client transport
         @param writer writable client transport
-        @param addr expected server address
-        @param port expect server port
+        @param sreader readable server transport
+        @param swriter writable server transport
         '''
 
-        async def handler(sreader, swriter):
-            raddr, _ = sreader.get_extra_info('peername')
-            if raddr != addr:  # make sure this is the right server
-                error(f'wrong server connecting to BIND: {raddr}')
-                return
+        sock = writer.get_extra_info('socket')
+        ssock = swriter.get_extra_info('socket')
+
+        if sock is not None and ssock is not None:
+            # we read the sockets ourselves; pause the transports
+            # so the event loop no longer reads behind our back,
+            # then forward whatever they buffered before the pause
+            writer.transport.pause_reading()
+            swriter.transport.pause_reading()
+
+            if _SPLICE:
+                relays = (
+                    self._relay_splice(sock, ssock, _buffered(reader), swriter),
+                    self._relay_splice(ssock, sock, _buffered(sreader), writer))
+            else:
+                relays = (
+                    self._relay_raw(sock, ssock, _buffered(reader)),
+                    self._relay_raw(ssock, sock, _buffered(sreader)))
+        else:
+            relays = (
+                self._relay(reader, swriter),
+                self._relay(sreader, writer))
 
-            # set up relays
-            asyncio.create_task(self._relay(reader, swriter))
-            asyncio.create_task(self._relay(sreader, writer))
+        try:
+            results = await asyncio.gather(*relays, return_exceptions=True)
+
+            # the relays swallow OSError themselves: anything else
+            # coming back is a bug, and dropping it here would make
+            # every connection on this path die without a trace
+            for res in results:
+                if isinstance(res, Exception) and not isinstance(res, OSError):
+                    error(f'relay died unexpectedly: {res!r}')
+        finally:
+            await self._close(writer)
+            await self._close(swriter)
+
+    async def _close(self, writer):
+        '''@brief close a stream writer and wait for its fd
+
+        @details without the wait the fd is only returned to the os
+        whenever the event loop gets around to it, which under load
+        is how servers run out of descriptors.
+        '''
 
-    async def _relay(self, reader, writer):
-        '''@brief forward all bytes read from reader to writer
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _relay_splice(self, src, dst, initial, writer):
+        '''@brief forward all bytes from src to dst kernel side
+
+        @details splice src into a pipe and the pipe into dst, so
+        the payload is moved page by page inside the kernel and
+        never copied into (or allocated in) userspace. the initial
+        bytes go through the pipe as well.
+
+        @param src source socket
+        @param dst destination socket
+        @param initial bytes to forward before splicing
+        @param writer destination stream writer, for the half-close
+        '''
+
+        loop = asyncio.get_running_loop()
+
+        # the transports still own the original fds and the event
+        # loop refuses to watch those; dups share the underlying
+        # socket but are ours to register
+        rfd = os.dup(src.fileno())
+        wfd = os.dup(dst.fileno())
+
+        prd, pwr = os.pipe()
+        os.set_blocking(prd, False)
+        os.set_blocking(pwr, False)
+
+        try:
+            # the pipe is empty between iterations, so these
+            # writes cannot block
+            fm = memoryview(initial)
+            while fm:
+                n = os.write(pwr, fm)
+                await self._splice_out(loop, prd, wfd, n)
+                fm = fm[n:]
+
+            splice, bufsize = os.splice, self._bufsize
+
+            while True:
+                try:
+                    n = splice(rfd, pwr, bufsize, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    await _readable(loop, rfd)
+                    continue
+
+                if n == 0:
+                    # half-close only: the other direction may
+                    # still be relaying
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    break
+
+                await self._splice_out(loop, prd, wfd, n)
+        except OSError:
+            pass
+        finally:
+            os.close(prd)
+            os.close(pwr)
+            os.close(rfd)
+            os.close(wfd)
+
+    async def _relay_raw(self, src, dst, initial):
+        '''@brief forward all bytes from src to dst
+
+        @details read the raw socket into a pooled buffer and send
+        it straight back out, so the relay allocates nothing per
+        chunk: the streams layer would buffer every read twice,
+        slice a fresh bytes object out, and buffer the write again,
+        this path reuses one bytearray for the whole connection and
+        returns it to the pool afterwards.
+
+        @param src source socket
+        @param dst destination socket
+        @param initial bytes to forward before relaying
+        '''
+
+        loop = asyncio.get_running_loop()
+
+        # the transports own the original fds and the event loop
+        # refuses to watch those; dups share the underlying
+        # sockets but are ours to register. dup'd sockets come
+        # back blocking at the python level, and the loop methods
+        # want them non-blocking
+        src = src.dup()
+        dst = dst.dup()
+        src.setblocking(False)
+        dst.setblocking(False)
+
+        buf = _getbuf(self._bufsize)
+        view = memoryview(buf)
+
+        recv_into, sendall = loop.sock_recv_into, loop.sock_sendall
+
+        try:
+            if initial:
+                await sendall(dst, initial)
+
+            while True:
+                n = await recv_into(src, view)
+                if n == 0:
+                    # half-close only: the other direction may
+                    # still be relaying
+                    dst.shutdown(SHUT_WR)
+                    break
+
+                # sendall returns only once the chunk is out, so
+                # the buffer is free for the next read
+                await sendall(dst, view[:n])
+        except OSError:
+            pass
+        finally:
+            src.close()
+            dst.close()
+            _putbuf(buf)
+
+    async def _splice_out(self, loop, prd, wfd, n):
+        '''@brief splice n buffered bytes out of the pipe into wfd
         '''
 
-        fm = await reader.read(1 << 12)
-        while fm:
+        while n:
             try:
-                writer.write(fm)
-                await writer.drain()
-            except:
-                break
-            fm = await reader.read(1 << 12)
-        writer.close()
+                n -= os.splice(prd, wfd, n, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                await _writable(loop, wfd)
+
+    async def _relay(self, reader, writer, eof=True, moved=None):
+        '''@brief forward all bytes read from reader to writer
+
+        @details the write buffer limits are zeroed so drain only
+        returns once the chunk is fully flushed: we already pace
+        ourselves with one drain per chunk, letting the transport
+        queue chunks on top of that just buffers them twice.
+
+        @param reader source stream
+        @param writer destination stream
+        @param eof whether to half-close the writer on eof
+        @param moved one-element list bumped per chunk, so the
+            caller can watch whether bytes are still flowing
+        '''
+
+        writer.transport.set_write_buffer_limits(high=0, low=0)
+
+        # bound to locals: one attribute lookup per connection
+        # instead of three per chunk
+        read, bufsize = reader.read, self._bufsize
+        write, drain = writer.write, writer.drain
+        pending = writer.transport.get_write_buffer_size
+        closing = writer.transport.is_closing
+
+        try:
+            fm = await read(bufsize)
+            while fm:
+                write(fm)
+                if moved is not None:
+                    moved[0] += 1
+
+                # write usually pushes the whole chunk into the
+                # kernel buffer, in which case drain has nothing to
+                # wait on and the loop turn it costs can be skipped.
+                # a closed transport swallows writes silently, so
+                # drain must still run to surface the error
+                if pending() or closing():
+                    await drain()
+
+                fm = await read(bufsize)
+
+            # half-close only: the other direction may still be
+            # relaying. a targeted except lets cancellation
+            # propagate so teardown can close the partner
+            if eof and writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            writer.close()
 
 
 def run():
@@ -171,10 +682,26 @@ def run():
     parser = argparse.ArgumentParser('socks4 proxy server')
     parser.add_argument('-i', '--ip', default=gethostname(),
         help='serve on which host')
-    parser.add_argument('-p', '--port', default=8080,
+    parser.add_argument('-p', '--port', type=int, default=8080,
         help='serve on which port')
     parser.add_argument('-l', '--log', action='store_const', const=True, default=False)
+    parser.add_argument('-b', '--bufsize', type=int, default=_RELAY_BUFSIZE,
+        help='relay buffer size in bytes')
+    parser.add_argument('-r', '--reuse', action='store_const', const=True, default=False,
+        help='pool upstream connections for reuse')
+    parser.add_argument('-m', '--max-conns', type=int, default=_MAX_CONNS,
+        help='serve at most this many connections at once')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='number of worker processes sharing the port')
     args = parser.parse_args()
 
-    Socks(args.ip, args.port, args.log).start()
+    # one event loop can saturate a single core on relay copies;
+    # fork workers sharing the port to use the others
+    workers = max(args.workers, 1)
+    for _ in range(workers - 1):
+        if os.fork() == 0:
+            break
+
+    Socks(args.ip, args.port, args.log, args.bufsize, args.reuse,
+        args.max_conns, reuseport=workers > 1).start()
 
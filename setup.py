@@ -5,6 +5,9 @@ setup(
     name='hoopy',
     version='0.0.1',
     packages=find_packages(),
+    extras_require={
+        'uvloop': ['uvloop; platform_system != "Windows"'],
+    },
     entry_points={'console_scripts': [
         'hoopy=hoopy.asocks:run',
     ]},